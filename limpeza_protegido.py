@@ -3,9 +3,14 @@
 # =============================================================================
 import streamlit as st
 import hashlib
-from datetime import datetime, timezone
 from st_supabase_connection import SupabaseConnection
 import time
+import random
+import re
+import os
+
+# Precisa ser o primeiro comando Streamlit do script, antes da barreira de acesso
+st.set_page_config(page_title="Limpar Cabeçalho TXT", page_icon="🧹", layout="centered")
 
 def init_connection():
     """Inicializa conexão com Supabase. Requer secrets configurados."""
@@ -15,6 +20,9 @@ def init_connection():
         st.error(f"Erro ao conectar com Supabase: {e}")
         return None
 
+# Esperas (s) antes de cada nova busca quando o token ainda não aparece no banco
+TOKEN_LOOKUP_BACKOFF = (0.1, 0.2, 0.4)
+
 def verify_and_consume_nonce(token: str) -> tuple[bool, str | None]:
     """Verifica um token de uso único (nonce) no banco de dados e o consome."""
     conn = init_connection()
@@ -25,30 +33,38 @@ def verify_and_consume_nonce(token: str) -> tuple[bool, str | None]:
         # 1. Cria o hash do token recebido para procurar no banco
         token_hash = hashlib.sha256(token.encode()).hexdigest()
         
-        # 2. Procura pelo token no banco de dados
-        response = conn.table("auth_tokens").select("*").eq("token_hash", token_hash).execute()
-        
-        if not response.data:
+        # 2. Valida e consome o token numa única chamada atômica (ver sql/consume_auth_token.sql).
+        #    O portal pode ainda não ter gravado o token quando o link é aberto: tenta de novo com backoff.
+        response = conn.client.rpc("consume_auth_token", {"p_hash": token_hash}).execute()
+        for delay in TOKEN_LOOKUP_BACKOFF:
+            if response.data and response.data[0]["status"] != "not_found":
+                break
+            time.sleep(delay + random.uniform(0, delay / 2))
+            response = conn.client.rpc("consume_auth_token", {"p_hash": token_hash}).execute()
+
+        result = response.data[0] if response.data else {"status": "not_found", "user_email": None}
+        status = result["status"]
+
+        if status == "not_found":
             st.error("Token de acesso inválido ou não encontrado.")
             return False, None
         
-        token_data = response.data[0]
-        
         # 3. Verifica se o token já foi utilizado
-        if token_data["is_used"]:
+        if status == "used":
             st.error("Este link de acesso já foi utilizado e não é mais válido.")
             return False, None
             
         # 4. Verifica se o token expirou
-        expires_at = datetime.fromisoformat(token_data["expires_at"])
-        if datetime.now(timezone.utc) > expires_at:
+        if status == "expired":
             st.error("O link de acesso expirou. Por favor, gere um novo no portal.")
             return False, None
+
+        if status != "ok":
+            st.error(f"Resposta inesperada ao validar o acesso: {status}")
+            return False, None
             
-        # 5. Se tudo estiver correto, marca o token como usado (consumido)
-        conn.table("auth_tokens").update({"is_used": True}).eq("id", token_data["id"]).execute()
-        
-        user_email = token_data["user_email"]
+        # 5. Token válido: a função já o marcou como usado (consumido)
+        user_email = result["user_email"]
         return True, user_email
         
     except Exception as e:
@@ -63,7 +79,6 @@ if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
 
 if token and not st.session_state.authenticated:
-    time.sleep(1) # PAUSA ESTRATÉGICA PARA EVITAR RACE CONDITION
     is_valid, email = verify_and_consume_nonce(token)
     if is_valid:
         st.session_state.authenticated = True
@@ -93,12 +108,6 @@ st.success(f"Autenticação bem-sucedida! Bem-vindo, {st.session_state.get('user
 # Streamlit - Limpar cabeçalho de TXT e manter apenas a(s) tabela(s)
 # Funciona bem com arquivos TRIOS/TA Instruments e afins.
 
-import re
-import io
-import os
-
-st.set_page_config(page_title="Limpar Cabeçalho TXT", page_icon="🧹", layout="centered")
-
 st.title("🧹 Limpar Cabeçalho de TXT")
 st.write(
     "Envie um arquivo `.txt` com cabeçalho (metadata) + tabela. "
@@ -108,14 +117,18 @@ st.write(
 # --------------------------
 # Utilidades de parsing
 # --------------------------
-NUM_RE = re.compile(r'^[+-]?((\d+(\.\d*)?)|(\.\d+))([eE][+-]?\d+)?$')
+NUM_RE = re.compile(r'[+-]?((\d+(\.\d*)?)|(\.\d+))([eE][+-]?\d+)?')
+
+# Palavras que denunciam linhas de log/metadados no meio da tabela (comparadas em minúsculas)
+NOISE_KEYWORDS = (":", "segment", "started", "version", "entry", "log", "calibration")
+NOISE_RE = re.compile("|".join(map(re.escape, NOISE_KEYWORDS)))
 
 def split_tokens(line: str):
-    # Divide por qualquer espaço/aba múltipla
-    return re.findall(r'\S+', line.strip())
+    # Divide por qualquer espaço/aba múltipla (split() sem argumentos já ignora as pontas)
+    return line.split()
 
 def is_numeric_token(tok: str) -> bool:
-    return bool(NUM_RE.match(tok))
+    return NUM_RE.fullmatch(tok) is not None
 
 def looks_like_column_header(line: str) -> bool:
     """
@@ -123,24 +136,53 @@ def looks_like_column_header(line: str) -> bool:
     pouca ou nenhuma numeração, e não conter ':' (que é comum em metadados).
     Ex.: 'Time Temperature Weight Weight'
     """
+    # Testes baratos primeiro: a maioria das linhas (dados, metadados) cai aqui
+    if ':' in line:
+        return False
     tokens = split_tokens(line)
     if len(tokens) < 2:
         return False
-    alpha_tokens = sum(any(ch.isalpha() for ch in t) and not any(ch.isdigit() for ch in t) for t in tokens)
-    has_colon = any(':' in t for t in tokens)
-    return (alpha_tokens >= 2) and (not has_colon)
-
-def find_table_start(lines):
+    # Só então examina caractere a caractere, parando no segundo token "palavra"
+    alpha_tokens = 0
+    for t in tokens:
+        if any(ch.isalpha() for ch in t) and not any(ch.isdigit() for ch in t):
+            alpha_tokens += 1
+            if alpha_tokens >= 2:
+                return True
+    return False
+
+def numeric_ratio(tokens) -> float:
+    """Fração dos tokens que são números (0.0 se não houver tokens)."""
+    if not tokens:
+        return 0.0
+    return sum(map(is_numeric_token, tokens)) / len(tokens)
+
+def find_table_start(lines, start=0):
     """
     Retorna (idx_header, idx_units, idx_data) se encontrar cabeçalho+unidades+tabela.
     Caso contrário, retorna (None, None, idx_data_inferido) usando heurística numérica.
+    Só considera lines[start:]; os índices retornados são relativos a lines inteiro.
     """
+    # Cada linha é tokenizada/avaliada no máximo uma vez, mesmo sendo revisitada
+    # pelas janelas de validação abaixo.
+    shapes = {}
+
+    def line_shape(idx):
+        """(número de tokens, fração numérica) da linha idx, com memoização."""
+        shape = shapes.get(idx)
+        if shape is None:
+            toks = split_tokens(lines[idx])
+            shape = shapes[idx] = (len(toks), numeric_ratio(toks))
+        return shape
+
     # 1) Caminho preferencial: bloco [step] -> header -> units -> dados
-    step_positions = [i for i, ln in enumerate(lines) if "[step]" in ln.lower()]
-    search_starts = step_positions + [0]  # também tenta desde o início, caso não exista [step]
+    # Só o primeiro [step] importa: a varredura a partir dele já cobre os
+    # seguintes. Depois tenta o trecho anterior (ou o arquivo todo, se não houver [step]).
+    first_step = next((i for i in range(start, len(lines)) if "[step]" in lines[i].lower()), start)
+    search_ranges = [range(first_step, len(lines) - 2), range(start, min(first_step, len(lines) - 2))]
 
-    for start in search_starts:
-        for i in range(start, len(lines) - 2):
+    for search_range in search_ranges:
+        for i in search_range:
             if looks_like_column_header(lines[i]):
                 # Assume próxima linha são unidades e depois começam dados
                 header_idx = i
@@ -148,36 +190,25 @@ def find_table_start(lines):
                 data_idx = i + 2
                 # Sanidade: verifique se as duas primeiras linhas de dados parecem numéricas
                 if data_idx < len(lines) - 1:
-                    t1 = split_tokens(lines[data_idx])
-                    t2 = split_tokens(lines[data_idx + 1])
-                    if len(t1) >= 2 and len(t2) >= 2:
-                        nratio1 = sum(is_numeric_token(x) for x in t1) / max(1, len(t1))
-                        nratio2 = sum(is_numeric_token(x) for x in t2) / max(1, len(t2))
-                        if nratio1 >= 0.6 and nratio2 >= 0.6:
-                            return header_idx, units_idx, data_idx
+                    n1, nratio1 = line_shape(data_idx)
+                    n2, nratio2 = line_shape(data_idx + 1)
+                    if n1 >= 2 and n2 >= 2 and nratio1 >= 0.6 and nratio2 >= 0.6:
+                        return header_idx, units_idx, data_idx
 
     # 2) Fallback: encontra o primeiro bloco longo "numeric-like" consistente
-    for i in range(len(lines) - 6):
-        t0 = split_tokens(lines[i])
-        if len(t0) < 2:
-            continue
-        nratio0 = sum(is_numeric_token(x) for x in t0) / len(t0)
-        if nratio0 < 0.6:
+    for i in range(start, len(lines) - 6):
+        num_cols, nratio0 = line_shape(i)
+        if num_cols < 2 or nratio0 < 0.6:
             continue
         # Valida próximas linhas
-        num_cols = len(t0)
         good = True
         for k in range(1, 6):
-            tk = split_tokens(lines[i + k])
-            if len(tk) < 2:
-                good = False
-                break
-            nratio = sum(is_numeric_token(x) for x in tk) / len(tk)
-            if nratio < 0.6:
+            nk, nratio = line_shape(i + k)
+            if nk < 2 or nratio < 0.6:
                 good = False
                 break
             # opcional: aceita variação de colunas, mas prefere consistência
-            if abs(len(tk) - num_cols) > 1:
+            if abs(nk - num_cols) > 1:
                 good = False
                 break
         if good:
@@ -186,7 +217,7 @@ def find_table_start(lines):
     # Não encontrado
     return None, None, None
 
-def build_dataframe_like(lines, idx_header, idx_units, idx_data, max_rows_preview=50):
+def build_dataframe_like(lines, idx_header, idx_units, idx_data):
     """
     Constrói uma 'tabela' simples (lista de listas) + nomes de colunas (lista),
     sem depender de pandas (para reduzir dependências).
@@ -210,7 +241,7 @@ def build_dataframe_like(lines, idx_header, idx_units, idx_data, max_rows_previe
         if len(toks) < 2:
             continue
         # filtra óbvios ruídos de log
-        if any(k in ln.lower() for k in (":", "segment", "started", "version", "entry", "log", "calibration")):
+        if NOISE_RE.search(ln.lower()):
             # geralmente é texto; pula
             continue
         # mantém consistência de colunas
@@ -221,10 +252,6 @@ def build_dataframe_like(lines, idx_header, idx_units, idx_data, max_rows_previe
             break
         rows.append(toks)
 
-        if len(rows) >= max_rows_preview and st.session_state.get("preview_only", True):
-            # em preview limitamos para não pesar
-            pass
-
     # Se não há nomes, cria genéricos
     if not col_names:
         n = max((len(r) for r in rows), default=0)
@@ -249,18 +276,62 @@ def make_txt(col_names, rows, sep, include_header=True, decimal_to_dot=False):
     """
     Monta o texto final.
     """
-    def fix_decimal(tok: str) -> str:
+    if decimal_to_dot:
         # opcional: troca vírgula por ponto
-        if decimal_to_dot:
-            return tok.replace(",", ".")
-        return tok
+        rows = [[x.replace(",", ".") for x in r] for r in rows]
 
-    out = io.StringIO()
+    lines = [sep.join(r) for r in rows]
     if include_header and col_names:
-        out.write(sep.join(col_names) + "\n")
-    for r in rows:
-        out.write(sep.join(fix_decimal(x) for x in r) + "\n")
-    return out.getvalue()
+        lines.insert(0, sep.join(col_names))
+    if not lines:
+        return ""
+    return "\n".join(lines) + "\n"
+
+def decode_text(data) -> str:
+    """Decodifica com fallback simples (sem chardet para evitar dependência extra)."""
+    try:
+        return str(data, "utf-8")
+    except UnicodeDecodeError:
+        return str(data, "latin-1", "replace")
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def parse_file(raw_bytes: bytes, manual_skip: int, marker: str):
+    """
+    Decodifica o arquivo e extrai a tabela: (col_names, rows), ou None se o
+    início da tabela não for encontrado. Em cache pelo conteúdo do arquivo e
+    pelas opções de leitura, então reruns que só mudam a saída não reprocessam.
+    """
+    text = decode_text(raw_bytes)
+
+    lines = text.splitlines()
+    del text  # só as linhas são usadas daqui em diante
+
+    # Se o usuário pediu "manual_skip", aplique antes de qualquer heurística.
+    # Índices em vez de recortes: a lista não é copiada.
+    start_idx = manual_skip
+
+    # Se há marcador customizado, comece na primeira linha que o contém (se encontrado).
+    # O laço para no primeiro acerto, que costuma estar logo no início do arquivo.
+    if marker and marker.strip():
+        lower_marker = marker.lower()
+        for i in range(start_idx, len(lines)):
+            if lower_marker in lines[i].lower():
+                start_idx = i
+                break
+
+    h_idx, u_idx, d_idx = find_table_start(lines, start_idx)
+    if d_idx is None:
+        return None
+    return build_dataframe_like(lines, h_idx, u_idx, d_idx)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def build_download(table_key, col_names, _rows, sep, include_header, decimal_to_dot):
+    """
+    Gera os bytes do TXT final. Em cache: reruns que não mudam a tabela
+    (identificada por table_key) nem as opções de saída não refazem o arquivo.
+    """
+    return make_txt(col_names, _rows, sep, include_header=include_header,
+                    decimal_to_dot=decimal_to_dot).encode("utf-8")
 
 # --------------------------
 # UI
@@ -287,43 +358,14 @@ include_header = st.checkbox("Incluir linha com nomes das colunas na saída", va
 decimal_to_dot = st.checkbox("Trocar vírgula por ponto nos decimais", value=False)
 manual_skip = st.number_input("Ignorar N linhas manualmente (opcional)", min_value=0, value=0, step=1)
 
-st.session_state["preview_only"] = True
-
 if uploaded:
-    # Decodifica com fallback simples (sem chardet para evitar dependência extra)
-    raw = uploaded.read()
-    try:
-        text = raw.decode("utf-8")
-    except UnicodeDecodeError:
-        text = raw.decode("latin-1", errors="replace")
+    parsed = parse_file(uploaded.getvalue(), int(manual_skip), custom_marker)
 
-    # Se o usuário informou um marcador, e ele existir, começa a busca dali
-    lines_all = text.splitlines()
-
-    # Se o usuário pediu "manual_skip", aplique antes de qualquer heurística
-    if manual_skip > 0:
-        lines = lines_all[int(manual_skip):]
-        base_offset = int(manual_skip)
-    else:
-        lines = lines_all
-        base_offset = 0
-
-    # Se há marcador customizado, traga o trecho a partir dele (se encontrado)
-    if custom_marker and custom_marker.strip():
-        lower_marker = custom_marker.lower()
-        for i, ln in enumerate(lines):
-            if lower_marker in ln.lower():
-                lines = lines[i:]  # recorta a partir do marcador
-                base_offset += i
-                break
-
-    h_idx, u_idx, d_idx = find_table_start(lines)
-
-    if d_idx is None:
+    if parsed is None:
         st.error("Não consegui encontrar automaticamente o início da tabela. "
                  "Tente informar o 'Marcador antes da tabela' ou usar 'Ignorar N linhas'.")
     else:
-        col_names, rows = build_dataframe_like(lines, h_idx, u_idx, d_idx)
+        col_names, rows = parsed
         if not rows:
             st.warning("Tabela detectada, mas sem linhas válidas de dados. "
                        "Ajuste o marcador ou o 'Ignorar N linhas'.")
@@ -335,8 +377,9 @@ if uploaded:
             preview_text = make_txt(col_names, preview_rows, sep="\t", include_header=True)
             st.text_area("Prévia (primeiras linhas)", preview_text, height=220)
 
-            # Gera saída final
-            final_txt = make_txt(
+            # Gera saída final (o upload + as opções de leitura identificam a tabela)
+            final_data = build_download(
+                (uploaded.file_id, int(manual_skip), custom_marker),
                 col_names,
                 rows,
                 sep=sep_map[output_sep_label],
@@ -350,7 +393,7 @@ if uploaded:
 
             st.download_button(
                 "⬇️ Baixar TXT limpo",
-                data=final_txt.encode("utf-8"),
+                data=final_data,
                 file_name=out_name,
                 mime="text/plain",
             )
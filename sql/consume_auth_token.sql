@@ -0,0 +1,46 @@
+-- Valida e consome um token de acesso de uso único em uma única chamada.
+-- Chamado pelo app via: conn.client.rpc("consume_auth_token", {"p_hash": token_hash})
+--
+-- status retornado: 'ok' | 'not_found' | 'used' | 'expired'
+-- user_email só é preenchido quando status = 'ok'.
+
+create or replace function public.consume_auth_token(p_hash text)
+returns table(user_email text, status text)
+language plpgsql
+as $$
+declare
+    v_id public.auth_tokens.id%type;
+    v_is_used public.auth_tokens.is_used%type;
+    v_expires_at public.auth_tokens.expires_at%type;
+    v_user_email public.auth_tokens.user_email%type;
+begin
+    -- Trava a linha para que duas abas com o mesmo link não consumam o token ao mesmo tempo.
+    -- Lê só as colunas usadas abaixo.
+    select t.id, t.is_used, t.expires_at, t.user_email
+    into v_id, v_is_used, v_expires_at, v_user_email
+    from public.auth_tokens t
+    where t.token_hash = p_hash
+    for update;
+
+    if not found then
+        return query select null::text, 'not_found'::text;
+        return;
+    end if;
+
+    if v_is_used then
+        return query select null::text, 'used'::text;
+        return;
+    end if;
+
+    if now() > v_expires_at then
+        return query select null::text, 'expired'::text;
+        return;
+    end if;
+
+    update public.auth_tokens t
+    set is_used = true
+    where t.id = v_id;
+
+    return query select v_user_email::text, 'ok'::text;
+end;
+$$;